@@ -1,13 +1,60 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import openai
+import httpx
+import tiktoken
+import numpy as np
 import json
 import os
+import time
+import asyncio
+import queue
+import threading
+import contextlib
+import atexit
+import copy
+import uuid
+import csv
+import itertools
+import hashlib
+import hmac
+import sqlite3
+from collections import deque
 from datetime import datetime
-import requests
-from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
 import io
 import base64
 
+# Optional dependencies, imported once so the first upload doesn't pay for them
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_dumps(obj):
+    """Serialize to compact JSON bytes, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def json_loads(data):
+    """Parse JSON from bytes or a buffer, using orjson when available"""
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+def json_pretty(obj):
+    """Serialize to indented JSON text, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode('utf-8')
+    return json.dumps(obj, indent=2, ensure_ascii=False)
+
 # Must be the first Streamlit command
 st.set_page_config(
     page_title="OpenAI Chat Interface",
@@ -15,17 +62,31 @@ st.set_page_config(
     layout="wide"
 )
 
+RENDER_WINDOW_STEP = 50  # Chat messages drawn per page of the full history
+
 # Initialize session state variables if they don't exist
-if 'authenticated' not in st.session_state:
-    st.session_state.authenticated = False
-if 'messages' not in st.session_state:
-    st.session_state.messages = []
-if 'openai_key' not in st.session_state:
-    st.session_state.openai_key = None
-if 'show_full_history' not in st.session_state:
-    st.session_state.show_full_history = True
-if 'history_loaded' not in st.session_state:
-    st.session_state.history_loaded = False
+SESSION_DEFAULTS = {
+    'authenticated': False,
+    'messages': [],
+    'openai_key': None,
+    'show_full_history': True,
+    'render_window': RENDER_WINDOW_STEP,
+    'history_loaded': False,
+    'history_offset': 0,
+    'history_batch': None,
+    'summary': "",
+    'summary_upto': 0,
+}
+
+def init_state():
+    """Set any missing session state variables to their defaults"""
+    for key, value in SESSION_DEFAULTS.items():
+        st.session_state.setdefault(key, copy.copy(value))
+    # Tags this session's history records so it can skip them when reading the file back
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+
+init_state()
 
 # Hide Streamlit branding
 hide_streamlit_style = """
@@ -37,161 +98,708 @@ hide_streamlit_style = """
 st.markdown(hide_streamlit_style, unsafe_allow_html=True)
 
 # Configuration
-HISTORY_FILE = "chat_history.json"
+HISTORY_FILE = "chat_history.jsonl"
+LEGACY_HISTORY_FILE = "chat_history.json"  # Pre-JSONL history, migrated on first load
+HISTORY_BUFFER_SIZE = 1 << 16
 ALLOWED_TYPES = ["txt", "pdf", "csv", "json", "py", "md", "png", "jpg", "jpeg"]
 MAX_FILE_SIZE = 5 * 1024 * 1024  # 5MB
 MAX_IMAGE_SIZE = (1024, 1024)  # Maximum dimensions for images
+RESAMPLE_FILTER = "BICUBIC"  # PIL resampling filter for downscaling; "LANCZOS" is sharper but slower
+LOW_DETAIL_MAX_DIM = 512  # Images smaller than this are sent to vision at low detail
+MAX_TEXT_CHARS = 200_000  # Characters of an uploaded text file passed on to the model
+CSV_HEAD_ROWS = 20  # Leading rows of an uploaded CSV passed on to the model
+CSV_TAIL_ROWS = 5  # Trailing rows of an uploaded CSV passed on to the model
+MAX_PDF_PAGES = 50  # Pages of an uploaded PDF passed on to the model
+MAX_PARALLEL_REQUESTS = 8  # Concurrent OpenAI requests when analyzing several images
+VISION_IMAGES_PER_REQUEST = 4  # Images analyzed together in one vision request
+VISION_MAX_TOKENS = 500  # Reply length allowed per image in a vision request
+MAX_CONTEXT_TOKENS = 8000  # Token budget for history sent with each request
+MAX_CONTEXT_MESSAGES = 40  # Most recent messages sent with each request, whatever their size
+MAX_FILE_TOKENS = 60_000  # Token cap for an "Analyzing files" message, which is sent outside the budget above
+FILES_MESSAGE_PREFIX = "Analyzing files:\n\n"
+CHAT_MODEL = "gpt-4o"
+SYSTEM_PROMPT = "You are a helpful assistant with perfect memory of the conversation history."
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+SUMMARY_MODEL = "gpt-4o-mini"  # Cheap model for the rolling summary of older turns
+SUMMARY_EVERY = 10  # Dropped messages to collect before refreshing the summary
+SUMMARY_CHARS_PER_MESSAGE = 2000  # Per-message cap when feeding old turns to the summarizer
+SUMMARY_MAX_TOKENS = 8000  # Token budget for the old turns sent in one summary refresh
+RESPONSE_CACHE_FILE = os.path.join(".cache", "openai_responses.db")
+RESPONSE_CACHE_SIZE = 5000  # Most recent responses kept in the exact-match cache
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.95  # Cosine similarity above which a past answer is reused
+SEMANTIC_CACHE_SIZE = 1000  # Most recent opening prompts kept in the semantic cache
 
 def process_image(uploaded_file):
-    """Process uploaded image file"""
+    """Process uploaded image file, returning (resized JPEG bytes, vision detail) and any error"""
+    # Pillow is only loaded once someone actually uploads an image
+    from PIL import Image
+    
     try:
         image_bytes = uploaded_file.getvalue()
         image = Image.open(io.BytesIO(image_bytes))
+        # Let libjpeg decode large JPEGs at 1/2, 1/4 or 1/8 scale; a no-op for other formats
+        image.draft('RGB', MAX_IMAGE_SIZE)
         
         if image.mode != 'RGB':
             image = image.convert('RGB')
         
-        # Resize if needed
-        ratio = min(MAX_IMAGE_SIZE[0] / image.size[0], MAX_IMAGE_SIZE[1] / image.size[1])
-        if ratio < 1:
-            new_size = tuple(int(dim * ratio) for dim in image.size)
-            image = image.resize(new_size, Image.LANCZOS)
+        # Shrink in place to fit, keeping the aspect ratio; a no-op for small images
+        image.thumbnail(MAX_IMAGE_SIZE, Image.Resampling[RESAMPLE_FILTER])
         
         # Save to buffer
         buffer = io.BytesIO()
         image.save(buffer, format="JPEG", quality=85)
-        return base64.b64encode(buffer.getvalue()).decode('utf-8')
+        # Small images lose nothing at low detail, which costs a flat ~85 tokens
+        detail = "low" if max(image.size) < LOW_DETAIL_MAX_DIM else "high"
+        return (buffer.getvalue(), detail), None
     except Exception as e:
-        st.error(f"Error processing image: {str(e)}")
-        return None
+        return None, f"Error processing image: {str(e)}"
+
+@st.cache_resource
+def get_app_password_digest():
+    """Hash the app password from secrets once per process"""
+    return hashlib.sha256(st.secrets["app_password"].encode('utf-8')).digest()
 
 def authenticate_app(password):
     """Authentication function for app password"""
     try:
-        return password == st.secrets["app_password"]
+        expected = get_app_password_digest()
     except Exception as e:
         st.error(f"Error accessing secrets: {str(e)}")
         return False
+    # Compare fixed-length digests in constant time
+    return hmac.compare_digest(expected, hashlib.sha256(password.encode('utf-8')).digest())
 
+@st.cache_resource
+def get_openai_client(api_key):
+    """Return a shared OpenAI client so connections are reused across reruns"""
+    # HTTP/2 multiplexes concurrent requests (e.g. image analyses) over one connection
+    http_client = httpx.Client(http2=True, limits=httpx.Limits(max_keepalive_connections=20))
+    return openai.OpenAI(api_key=api_key, http_client=http_client)
+
+@st.cache_data(ttl=3600, show_spinner=False)
 def validate_api_key(api_key):
-    """Validate OpenAI API key"""
+    """Validate OpenAI API key; network and server errors are raised so they aren't cached"""
     try:
-        client = openai.OpenAI(api_key=api_key)
-        client.models.list()
+        # A throwaway client, so rejected keys don't each leave a pooled client in the cache
+        with openai.OpenAI(api_key=api_key) as client:
+            # Fetching the one model we use is a tiny response, unlike listing them all
+            client.models.retrieve(CHAT_MODEL)
         return True
-    except:
+    except (openai.AuthenticationError, openai.PermissionDeniedError, openai.NotFoundError):
         return False
 
+@st.cache_data(max_entries=4, show_spinner=False)
+def parse_history_file(path, mtime, size):
+    """Parse a history file into (messages, bytes parsed), cached until its mtime or size changes"""
+    with open(path, 'rb') as f:
+        content = f.read()
+    
+    # Legacy files hold a single JSON array
+    if content.lstrip().startswith(b'['):
+        return json_loads(content), None
+    
+    # Stop at the last complete record; a partial trailing line is read later
+    end = content.rfind(b'\n') + 1
+    return [json_loads(line) for line in content[:end].splitlines() if line.strip()], end
+
 def load_chat_history():
-    """Load chat history from JSON file"""
+    """Load chat history from JSONL file, migrating the legacy JSON file if present"""
+    st.session_state.history_offset = 0
     try:
         if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'r') as f:
-                return json.load(f)
-        return []
+            path = HISTORY_FILE
+        elif os.path.exists(LEGACY_HISTORY_FILE):
+            path = LEGACY_HISTORY_FILE
+        else:
+            return []
+        
+        # New sessions and reloads of an unchanged file skip parsing it again
+        stat = os.stat(path)
+        history, end = parse_history_file(path, stat.st_mtime_ns, stat.st_size)
+        if end is None:
+            # Rewrite legacy files once as JSONL
+            compact_history(history)
+        else:
+            st.session_state.history_offset = end
+        return history
     except Exception as e:
         st.error(f"Error loading chat history: {str(e)}")
         return []
 
-def save_chat_history(history):
-    """Save chat history to JSON file"""
+def load_chat_history_incremental():
+    """Read only the JSONL records appended since the last read into the cached history"""
     try:
-        with open(HISTORY_FILE, 'w') as f:
-            json.dump(history, f, indent=2)
+        with open(HISTORY_FILE, 'rb') as f:
+            f.seek(st.session_state.history_offset)
+            lines = f.readlines()
+        
+        for line in lines:
+            if not line.endswith(b'\n'):
+                break
+            if line.strip():
+                message = json_loads(line)
+                # Our own records are already in memory
+                if message.get("sid") != st.session_state.session_id:
+                    st.session_state.messages.append(message)
+            st.session_state.history_offset += len(line)
+    except ValueError:
+        # The file was replaced with a larger one, so our offset points mid-record
+        st.session_state.messages = load_chat_history()
+    except Exception as e:
+        st.error(f"Error loading chat history: {str(e)}")
+
+def get_chat_history():
+    """Return the cached chat history, reading only what other sessions appended"""
+    # Our own queued writes must be on disk before comparing sizes
+    flush_history()
+    try:
+        size = os.path.getsize(HISTORY_FILE)
+    except OSError:
+        size = 0
+    
+    # A file smaller than our offset was cleared or replaced, so reload it fully
+    if not st.session_state.history_loaded or size < st.session_state.history_offset:
+        st.session_state.messages = load_chat_history()
+        st.session_state.history_loaded = True
+    elif size > st.session_state.history_offset:
+        load_chat_history_incremental()
+    return st.session_state.messages
+
+def serializable(message):
+    """Drop in-memory cache fields (prefixed with '_') before a message is written"""
+    return {k: v for k, v in message.items() if not k.startswith('_')}
+
+def compact_history(history):
+    """Rewrite the whole history file from a list (legacy migration and Clear History only)"""
+    close_history_writer()
+    try:
+        # Write a temp file and swap it in so readers never see a half-written history
+        tmp_file = HISTORY_FILE + ".tmp"
+        with open(tmp_file, 'wb') as f:
+            f.writelines(json_dumps(serializable(msg)) + b'\n' for msg in history)
+            offset = f.tell()
+        os.replace(tmp_file, HISTORY_FILE)
+        st.session_state.history_offset = offset
     except Exception as e:
         st.error(f"Error saving chat history: {str(e)}")
 
+def same_file(fh, path):
+    """Check whether an open file handle still refers to the file at path"""
+    try:
+        st_path = os.stat(path)
+    except OSError:
+        return False
+    st_fh = os.fstat(fh.fileno())
+    return (st_fh.st_dev, st_fh.st_ino) == (st_path.st_dev, st_path.st_ino)
+
+def history_writer_loop(writes, errors):
+    """Append queued records to the history file, flushing whenever the queue drains"""
+    fh = None
+    while True:
+        items = [writes.get()]
+        # Take everything else already queued so it all goes out in one write
+        while True:
+            try:
+                items.append(writes.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            # Reopen if the file was deleted or replaced behind our back
+            if fh is not None and not same_file(fh, HISTORY_FILE):
+                fh.close()
+                fh = None
+            for data in items:
+                if data is None:
+                    # Close request: the file is about to be renamed or rewritten
+                    if fh is not None:
+                        fh.close()
+                        fh = None
+                    continue
+                if fh is None:
+                    fh = open(HISTORY_FILE, 'ab', buffering=HISTORY_BUFFER_SIZE)
+                fh.write(data)
+            if fh is not None:
+                fh.flush()
+        except Exception as e:
+            errors.append(str(e))
+        finally:
+            for _ in items:
+                writes.task_done()
+
+@st.cache_resource
+def get_history_writer():
+    """Start the process-wide thread that writes history off the request path"""
+    writes = queue.Queue()
+    errors = []
+    threading.Thread(target=history_writer_loop, args=(writes, errors), daemon=True).start()
+    # Let queued messages reach the disk on a normal shutdown
+    atexit.register(writes.join)
+    return writes, errors
+
+def flush_history():
+    """Wait until all queued history writes are on disk"""
+    writes, errors = get_history_writer()
+    writes.join()
+    while errors:
+        st.error(f"Error saving chat history: {errors.pop(0)}")
+
+def close_history_writer():
+    """Flush and close the history handle before the file is rewritten or renamed"""
+    writes, _ = get_history_writer()
+    writes.put(None)
+    flush_history()
+
+def append_message(message):
+    """Add a message to the cached history and append it to the JSONL file"""
+    st.session_state.messages.append(message)
+    # Payload and newline go out as a single write so records never interleave. The
+    # offset is left alone: other sessions' records may land first, so the next read
+    # picks ours up from the file and skips them by session id
+    line = json_dumps({**serializable(message), "sid": st.session_state.session_id}) + b'\n'
+    if st.session_state.history_batch is not None:
+        st.session_state.history_batch.append(line)
+    else:
+        get_history_writer()[0].put(line)
+
+@contextlib.contextmanager
+def history_batch():
+    """Collect the appends made inside the block into a single queued write"""
+    if st.session_state.history_batch is not None:
+        # Already inside a batch; the outer block writes everything
+        yield
+        return
+    
+    st.session_state.history_batch = []
+    try:
+        yield
+    finally:
+        # Runs even when st.rerun() interrupts the block
+        lines, st.session_state.history_batch = st.session_state.history_batch, None
+        if lines:
+            get_history_writer()[0].put(b''.join(lines))
+
+def column_type(values):
+    """Guess a CSV column's type from a sample of its values"""
+    values = [value for value in values if value != ""]
+    if not values:
+        return "empty"
+    for name, parse in (("integer", int), ("number", float)):
+        try:
+            for value in values:
+                parse(value)
+        except ValueError:
+            continue
+        return name
+    return "text"
+
+def process_text(uploaded_file):
+    """Process an uploaded text or source file"""
+    # Decode incrementally and stop at the character cap instead of copying the whole upload
+    uploaded_file.seek(0)
+    text = io.TextIOWrapper(uploaded_file, encoding='utf-8')
+    try:
+        content = text.read(MAX_TEXT_CHARS + 1)
+    finally:
+        text.detach()
+    if len(content) > MAX_TEXT_CHARS:
+        content = content[:MAX_TEXT_CHARS] + f"\n... (truncated after {MAX_TEXT_CHARS} characters)"
+    return content, None
+
+@st.cache_resource
+def get_pdfium_lock():
+    """Return the process-wide lock serializing PDFium calls"""
+    return threading.Lock()
+
+def process_pdf(uploaded_file):
+    """Process an uploaded PDF"""
+    if pdfium is None:
+        return None, "PDF support requires pypdfium2, which is not installed"
+    try:
+        # PDFium is not thread-safe, and every session runs in its own thread
+        with get_pdfium_lock():
+            # PDFium reads pages from the upload on demand instead of a copy of it
+            uploaded_file.seek(0)
+            pdf = pdfium.PdfDocument(uploaded_file)
+            try:
+                parts = [pdf[i].get_textpage().get_text_bounded() for i in range(min(len(pdf), MAX_PDF_PAGES))]
+                if len(pdf) > MAX_PDF_PAGES:
+                    parts.append(f"... (truncated after {MAX_PDF_PAGES} pages)")
+            finally:
+                pdf.close()
+        return "\n".join(parts), None
+    except Exception as e:
+        return None, f"Error processing PDF: {str(e)}"
+
+def process_csv(uploaded_file):
+    """Process an uploaded CSV"""
+    try:
+        # Send the columns, the first rows and the last rows rather than the whole table
+        uploaded_file.seek(0)
+        text = io.TextIOWrapper(uploaded_file, encoding='utf-8', newline='')
+        try:
+            reader = csv.reader(text)
+            header = next(reader, [])
+            head = list(itertools.islice(reader, CSV_HEAD_ROWS))
+            # Number the remaining rows so the row count comes out of the same pass
+            tail = deque(enumerate(reader, len(head) + 1), maxlen=CSV_TAIL_ROWS)
+        finally:
+            # Detach so closing the wrapper doesn't close the upload
+            text.detach()
+        row_count = tail[-1][0] if tail else len(head)
+        tail = [row for _, row in tail]
+        sample = head + tail
+        columns = ", ".join(
+            f"{name} ({column_type([row[i] for row in sample if i < len(row)])})"
+            for i, name in enumerate(header)
+        )
+        rows = [header] + head
+        omitted = row_count - len(sample)
+        if omitted:
+            rows.append([f"... ({omitted} rows omitted)"])
+        rows += tail
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(rows)
+        return f"Columns: {columns}\nRows: {row_count}\n\n{buffer.getvalue()}", None
+    except Exception as e:
+        return None, f"Error processing CSV: {str(e)}"
+
+def process_json(uploaded_file):
+    """Process an uploaded JSON file"""
+    try:
+        # Parse straight from the upload's buffer without copying it
+        content = json_loads(uploaded_file.getbuffer())
+        return json_pretty(content), None
+    except Exception as e:
+        return None, f"Error processing JSON: {str(e)}"
+
+# Upload handlers by file extension, each returning (content, error)
+HANDLERS = {
+    "txt": process_text,
+    "py": process_text,
+    "md": process_text,
+    "pdf": process_pdf,
+    "csv": process_csv,
+    "json": process_json,
+    "png": process_image,
+    "jpg": process_image,
+    "jpeg": process_image,
+}
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def process_upload(data, file_extension):
+    """Run the handler for an upload's bytes, cached on the content so re-analyzing is free"""
+    return HANDLERS[file_extension](io.BytesIO(data))
+
 def process_file(uploaded_file):
     """Process uploaded file and return its content"""
     try:
         file_extension = uploaded_file.name.split('.')[-1].lower()
         
-        if file_extension not in ALLOWED_TYPES:
+        if file_extension not in HANDLERS:
             return None, f"File type .{file_extension} is not supported"
         
         if uploaded_file.size > MAX_FILE_SIZE:
             return None, "File is too large (max 5MB)"
         
-        if file_extension in ['png', 'jpg', 'jpeg']:
-            return process_image(uploaded_file), None
-        
-        # Handle text-based files
-        if file_extension in ['txt', 'py', 'md']:
-            return uploaded_file.getvalue().decode('utf-8'), None
-        elif file_extension == 'pdf':
-            try:
-                import PyPDF2
-                pdf_reader = PyPDF2.PdfReader(uploaded_file)
-                content = ""
-                for page in pdf_reader.pages:
-                    content += page.extract_text() + "\n"
-                return content, None
-            except Exception as e:
-                return None, f"Error processing PDF: {str(e)}"
-        elif file_extension == 'csv':
-            try:
-                import pandas as pd
-                df = pd.read_csv(uploaded_file)
-                return df.to_string(), None
-            except Exception as e:
-                return None, f"Error processing CSV: {str(e)}"
-        elif file_extension == 'json':
-            try:
-                content = json.loads(uploaded_file.getvalue())
-                return json.dumps(content, indent=2), None
-            except Exception as e:
-                return None, f"Error processing JSON: {str(e)}"
-        
-        return None, "Unsupported file type"
+        return process_upload(uploaded_file.getvalue(), file_extension)
     except Exception as e:
         return None, f"Error processing file: {str(e)}"
 
-def chat_with_openai(message, history):
-    """Chat function using OpenAI API"""
+@st.cache_resource
+def get_encoding():
+    """Return the tokenizer used to measure history against the token budget"""
+    return tiktoken.encoding_for_model(CHAT_MODEL)
+
+def api_view(message):
+    """Return the role/content dict sent to OpenAI, building it once per message"""
+    if "_api" not in message:
+        message["_api"] = {"role": message["role"], "content": message["content"]}
+    return message["_api"]
+
+def count_tokens(message):
+    """Count a message's tokens, caching the result on the message"""
+    if "_tokens" not in message:
+        message["_tokens"] = len(get_encoding().encode(message["content"], disallowed_special=()))
+    return message["_tokens"]
+
+def latest_upload(messages, max_messages=MAX_CONTEXT_MESSAGES):
+    """Return the newest "Analyzing files" message among the recent ones, or None"""
+    for msg in reversed(messages[-max_messages:]):
+        if msg["role"] == "user" and msg["content"].startswith(FILES_MESSAGE_PREFIX):
+            return msg
+    return None
+
+def trim_history(messages, max_tokens=MAX_CONTEXT_TOKENS, max_messages=MAX_CONTEXT_MESSAGES):
+    """Keep system messages plus the most recent messages that fit the token and message budgets"""
+    system = [msg for msg in messages if msg["role"] == "system"]
+    budget = max_tokens - sum(count_tokens(msg) for msg in system)
+    recent = []
+    for msg in reversed(messages):
+        if msg["role"] == "system":
+            continue
+        if len(recent) >= max_messages:
+            break
+        budget -= count_tokens(msg)
+        # Always keep the newest message, even if it alone exceeds the budget
+        if budget < 0 and recent:
+            break
+        recent.append(msg)
+    return system + recent[::-1]
+
+@st.cache_resource
+def get_response_cache():
+    """Open the on-disk response cache shared by all sessions"""
+    os.makedirs(os.path.dirname(RESPONSE_CACHE_FILE), exist_ok=True)
+    conn = sqlite3.connect(RESPONSE_CACHE_FILE, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS semantic (model TEXT NOT NULL, embedding BLOB NOT NULL, response TEXT NOT NULL)")
+    return conn
+
+@st.cache_resource
+def get_response_cache_lock():
+    """Return the process-wide lock serializing use of the shared cache connection"""
+    return threading.Lock()
+
+def response_cache_key(messages):
+    """Hash the model and conversation sent to OpenAI into a cache key"""
+    payload = json_dumps({"model": CHAT_MODEL, "msgs": [(msg["role"], msg["content"]) for msg in messages]})
+    return hashlib.blake2b(payload).hexdigest()
+
+def get_cached_response(key):
+    """Return a previously cached response, or None"""
+    try:
+        with get_response_cache_lock():
+            row = get_response_cache().execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error:
+        # A broken cache only costs a fresh request
+        return None
+    return row[0] if row else None
+
+@st.cache_resource
+def get_semantic_index():
+    """Load the embeddings of the latest opening prompts and their answers, shared by all sessions"""
+    with get_response_cache_lock():
+        rows = get_response_cache().execute(
+            "SELECT embedding, response FROM semantic WHERE model = ? ORDER BY rowid DESC LIMIT ?",
+            (EMBEDDING_MODEL, SEMANTIC_CACHE_SIZE),
+        ).fetchall()
+    # Sessions run in their own threads, so the lock lives with the index it guards
+    index = {"embeddings": None, "responses": [], "next": 0, "lock": threading.Lock()}
+    for blob, response in reversed(rows):
+        add_to_index(index, np.frombuffer(blob, dtype=np.float32), response)
+    return index
+
+def add_to_index(index, embedding, response):
+    """Store an embedding in the fixed-size index, overwriting the oldest entry once it is full"""
+    if index["embeddings"] is None:
+        index["embeddings"] = np.empty((SEMANTIC_CACHE_SIZE, embedding.size), dtype=np.float32)
+    slot = index["next"]
+    index["embeddings"][slot] = embedding
+    if slot < len(index["responses"]):
+        index["responses"][slot] = response
+    else:
+        index["responses"].append(response)
+    index["next"] = (slot + 1) % SEMANTIC_CACHE_SIZE
+
+def embed_prompt(client, text):
+    """Return the prompt's unit-length embedding, or None if the request fails"""
+    try:
+        embedding = client.embeddings.create(model=EMBEDDING_MODEL, input=text).data[0].embedding
+    except Exception:
+        return None
+    vector = np.asarray(embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def find_similar_response(embedding):
+    """Return the answer to the most similar past prompt if it clears the threshold, or None"""
+    index = get_semantic_index()
+    with index["lock"]:
+        count = len(index["responses"])
+        if not count:
+            return None
+        scores = index["embeddings"][:count] @ embedding
+        best = int(scores.argmax())
+        if scores[best] >= SEMANTIC_CACHE_THRESHOLD:
+            return index["responses"][best]
+    return None
+
+def remember_response(embedding, response):
+    """Add an answer to the semantic cache, in memory and on disk, dropping the oldest beyond the cap"""
+    index = get_semantic_index()
+    with index["lock"]:
+        add_to_index(index, embedding, response)
+        with get_response_cache_lock(), get_response_cache() as conn:
+            conn.execute("INSERT INTO semantic VALUES (?, ?, ?)", (EMBEDDING_MODEL, embedding.tobytes(), response))
+            conn.execute(
+                "DELETE FROM semantic WHERE rowid NOT IN (SELECT rowid FROM semantic ORDER BY rowid DESC LIMIT ?)",
+                (SEMANTIC_CACHE_SIZE,),
+            )
+
+def cache_stream(key, chunks, embedding=None):
+    """Pass streamed text through and cache the full response once it completes"""
+    parts = []
+    for text in chunks:
+        parts.append(text)
+        yield text
+    response = "".join(parts)
+    # The reply has already been shown, so a failed cache write must not lose it
+    try:
+        with get_response_cache_lock(), get_response_cache() as conn:
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?)", (key, response))
+            conn.execute(
+                "DELETE FROM responses WHERE rowid NOT IN (SELECT rowid FROM responses ORDER BY rowid DESC LIMIT ?)",
+                (RESPONSE_CACHE_SIZE,),
+            )
+        if embedding is not None:
+            remember_response(embedding, response)
+    except sqlite3.Error:
+        pass
+
+def update_summary(dropped, client):
+    """Fold messages that fell out of the context window into the rolling summary"""
+    if st.session_state.summary_upto > len(dropped):
+        # History was cleared or reloaded since the summary was written
+        st.session_state.summary = ""
+        st.session_state.summary_upto = 0
+    
+    # Refresh only every SUMMARY_EVERY dropped messages to keep the extra call rare
+    new = dropped[st.session_state.summary_upto:]
+    if len(new) < SUMMARY_EVERY:
+        return st.session_state.summary
+    
+    # Take the newest dropped messages that fit the budget; a new session over a long
+    # history would otherwise send all of them at once and overflow the summarizer
+    budget = SUMMARY_MAX_TOKENS
+    batch = []
+    for msg in reversed(new):
+        # A message cut to SUMMARY_CHARS_PER_MESSAGE can't have more tokens than characters
+        budget -= min(count_tokens(msg), SUMMARY_CHARS_PER_MESSAGE)
+        if budget < 0:
+            break
+        batch.append(msg)
+    transcript = "\n\n".join(f"{msg['role']}: {msg['content'][:SUMMARY_CHARS_PER_MESSAGE]}" for msg in reversed(batch))
+    
+    # Advance even if the call fails, so a bad request isn't retried on every turn
+    st.session_state.summary_upto = len(dropped)
+    try:
+        response = client.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": "Update the summary of a conversation with the new messages. Keep facts, decisions and open questions. Reply with the summary only."},
+                {"role": "user", "content": f"Current summary:\n{st.session_state.summary or '(none)'}\n\nNew messages:\n{transcript}"},
+            ],
+            temperature=0,
+        )
+        st.session_state.summary = response.choices[0].message.content
+    except Exception:
+        # A stale summary is better than failing the user's turn
+        pass
+    return st.session_state.summary
+
+def stream_text(stream):
+    """Yield the text deltas from a streamed chat completion"""
+    for chunk in stream:
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
+
+def chat_with_openai(history):
+    """Chat function using OpenAI API, replying to the last message in history"""
     try:
-        client = openai.OpenAI(api_key=st.session_state.openai_key)
-        messages = [{"role": "system", "content": "You are a helpful assistant with perfect memory of the conversation history."}]
-        messages.extend([{"role": msg["role"], "content": msg["content"]} for msg in history])
-        messages.append({"role": "user", "content": message})
+        client = get_openai_client(st.session_state.openai_key)
+        messages = [SYSTEM_MESSAGE]
+        recent = trim_history(history)
+        # Keep the latest upload in view even when it alone exceeds the token budget,
+        # so questions about the files still reach the model with them
+        upload = latest_upload(history)
+        if upload is not None and not any(msg is upload for msg in recent):
+            recent = trim_history(history, max_tokens=MAX_CONTEXT_TOKENS - count_tokens(upload))
+        else:
+            upload = None
+        # Older turns that no longer fit the budget are carried as a rolling summary
+        summary = update_summary(history[:len(history) - len(recent)], client)
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"})
+        if upload is not None:
+            messages.append(api_view(upload))
+        messages += [api_view(msg) for msg in recent]
+        
+        # Identical conversations get the stored answer without an API call
+        key = response_cache_key(messages)
+        cached = get_cached_response(key)
+        if cached is not None:
+            return iter([cached]), None
+        
+        # An opening prompt has no context to depend on, so a close paraphrase of an
+        # earlier one can reuse its answer. Decided on the full history: a trimmed
+        # window can hold just the newest message of a longer conversation
+        embedding = None
+        if len(history) == 1:
+            embedding = embed_prompt(client, messages[-1]["content"])
+            if embedding is not None:
+                cached = find_similar_response(embedding)
+                if cached is not None:
+                    return iter([cached]), None
         
         response = client.chat.completions.create(
-            model="gpt-4o",  # Fixed model name
+            model=CHAT_MODEL,
             messages=messages,
             temperature=0.1,
+            stream=True,
         )
-        return response.choices[0].message.content, None
+        return cache_stream(key, stream_text(response), embedding), None
     except Exception as e:
         return None, str(e)
         
-def chat_with_openai_vision(prompt, image_base64, history):
-    """Chat function for image analysis"""
+async def chat_with_openai_vision(client, prompt, images):
+    """Chat function for analyzing (name, (jpeg_bytes, detail)) images in one request using an async OpenAI client"""
     try:
-        client = openai.OpenAI(api_key=st.session_state.openai_key)
-        messages = [
-            {
-                "role": "user","role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_base64}",
-                            "detail": "high"
-                        }
-                    }
-                ]
-            }
-        ]
+        content = [{"type": "text", "text": prompt}]
+        for name, (jpeg_bytes, detail) in images:
+            if len(images) > 1:
+                content.append({"type": "text", "text": f"## {name}"})
+            # Build the data URL as bytes and decode the base64 once
+            image_url = (b"data:image/jpeg;base64," + base64.b64encode(jpeg_bytes)).decode('ascii')
+            content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": image_url,
+                    "detail": detail
+                }
+            })
         
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="gpt-4o",
-            messages=messages,
-            max_tokens=500,
+            messages=[{"role": "user", "content": content}],
+            max_tokens=VISION_MAX_TOKENS * len(images),
         )
         return response.choices[0].message.content, None
     except Exception as e:
         return None, str(e)
 
+async def analyze_images(images, api_key):
+    """Analyze (name, (jpeg_bytes, detail)) pairs in groups sent concurrently, keeping their order"""
+    # Async clients are tied to the event loop, so each batch gets its own
+    client = openai.AsyncOpenAI(api_key=api_key, http_client=httpx.AsyncClient(http2=True))
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_REQUESTS)
+    
+    async def analyze(group):
+        names = ", ".join(name for name, _ in group)
+        if len(group) == 1:
+            prompt = f"Please analyze this image: {names}"
+        else:
+            prompt = f"Please analyze these images, with one section per image: {names}"
+        async with semaphore:
+            return await chat_with_openai_vision(client, prompt, group)
+    
+    # Several images share one request, so N uploads cost far fewer round trips
+    groups = [images[i:i + VISION_IMAGES_PER_REQUEST] for i in range(0, len(images), VISION_IMAGES_PER_REQUEST)]
+    try:
+        return await asyncio.gather(*(analyze(group) for group in groups))
+    finally:
+        await client.close()
+
 def openai_auth_interface():
     """Handle OpenAI API key authentication"""
     st.header("OpenAI API Authentication")
@@ -211,6 +819,9 @@ def openai_auth_interface():
             else:
                 st.error("❌ API key in secrets is invalid")
                 return False
+        except openai.APIError:
+            st.error("⚠️ Couldn't reach OpenAI to check the API key, please try again")
+            return False
         except Exception as e:
             st.error("❌ No API key found in secrets or key is invalid")
             return False
@@ -219,7 +830,12 @@ def openai_auth_interface():
             api_key = st.text_input("Enter your OpenAI API key:", type="password")
             submitted = st.form_submit_button("Submit")
             if submitted:
-                if validate_api_key(api_key):
+                try:
+                    valid = validate_api_key(api_key)
+                except openai.APIError:
+                    st.error("⚠️ Couldn't reach OpenAI to check the API key, please try again")
+                    return False
+                if valid:
                     st.session_state.openai_key = api_key
                     st.success("✅ API key validated successfully!")
                     return True
@@ -228,13 +844,155 @@ def openai_auth_interface():
                     return False
     return False
 
+def render_caption(message):
+    """Show when a message was sent"""
+    if "ts" in message:
+        st.caption(f"Time: {datetime.fromtimestamp(message['ts'] / 1000).isoformat()}")
+    elif "timestamp" in message:  # Records written before epoch-ms timestamps
+        st.caption(f"Time: {message['timestamp']}")
+
+@st.fragment
+def render_chat():
+    """Render the chat log as a fragment so it can rerun apart from the rest of the app"""
+    messages = st.session_state.messages
+    if st.session_state.show_full_history:
+        # Only the newest render_window messages are drawn; older ones load on request
+        window = st.session_state.render_window
+        hidden = len(messages) - window
+        if hidden > 0 and st.button(f"Load {min(RENDER_WINDOW_STEP, hidden)} older messages"):
+            st.session_state.render_window += RENDER_WINDOW_STEP
+            # Rerun the whole app, not just this fragment, so turns drawn inline
+            # below the log by the last prompt aren't shown twice
+            st.rerun()
+        messages_to_show = messages[-window:]
+    else:
+        messages_to_show = messages[-10:]
+    
+    for message in messages_to_show:
+        with st.chat_message(message["role"]):
+            st.write(message["content"])
+            render_caption(message)
+
+@st.fragment
+def sidebar_ui():
+    """Render the sidebar as a fragment so file uploads don't rerun the chat log"""
+    st.header("Settings")
+    show_history = st.checkbox("Show Full History", value=st.session_state.show_full_history)
+    if show_history != st.session_state.show_full_history:
+        st.session_state.show_full_history = show_history
+        st.rerun()
+    
+    st.header("File Upload")
+    uploaded_files = st.file_uploader(
+        "Upload files to discuss",
+        type=ALLOWED_TYPES,
+        accept_multiple_files=True
+    )
+    
+    if uploaded_files:
+        if st.button("Analyze Files", use_container_width=True):
+            failed = False
+            truncated = False
+            # Parsing and image resizing run in C code that releases the GIL; workers
+            # get this session's script context so the cached handlers can run there
+            with ThreadPoolExecutor(
+                max_workers=min(MAX_PARALLEL_REQUESTS, len(uploaded_files)),
+                initializer=add_script_run_ctx,
+                initargs=(None, get_script_run_ctx()),
+            ) as executor:
+                processed = list(executor.map(process_file, uploaded_files))
+            
+            # Text files are combined into a single user message, images are analyzed separately
+            sections = []
+            images = []
+            for uploaded_file, (content, error) in zip(uploaded_files, processed):
+                if error:
+                    st.error(error)
+                    failed = True
+                elif uploaded_file.type.startswith('image/'):
+                    # Preview the resized JPEG rather than shipping the original upload to the browser
+                    st.image(content[0], caption=uploaded_file.name)
+                    images.append((uploaded_file.name, content))
+                else:
+                    sections.append(f"## {uploaded_file.name}\n{content}")
+            
+            # Vision requests run concurrently instead of one after another
+            results = []
+            if images:
+                results = asyncio.run(analyze_images(images, st.session_state.openai_key))
+            
+            with history_batch():
+                if sections:
+                    content = FILES_MESSAGE_PREFIX + "\n\n---\n\n".join(sections)
+                    # The files are always sent with later questions, so they must fit the model's context
+                    tokens = get_encoding().encode(content, disallowed_special=())
+                    if len(tokens) > MAX_FILE_TOKENS:
+                        content = get_encoding().decode(tokens[:MAX_FILE_TOKENS]) + f"\n... (truncated after {MAX_FILE_TOKENS} tokens)"
+                        st.warning(f"The uploaded files were too long and only their first {MAX_FILE_TOKENS} tokens will be sent to the model")
+                        truncated = True
+                    new_message = {
+                        "role": "user",
+                        "content": content,
+                        "ts": int(time.time() * 1000)
+                    }
+                    append_message(new_message)
+                for response, error in results:
+                    if error:
+                        st.error(error)
+                        failed = True
+                    else:
+                        new_message = {
+                            "role": "assistant",
+                            "content": response,
+                            "ts": int(time.time() * 1000)
+                        }
+                        append_message(new_message)
+            
+            # Show the new messages in the chat log, unless there are errors or warnings to read first
+            if not failed and not truncated:
+                st.rerun()
+    
+    st.markdown("---")
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("Clear Display", use_container_width=True):
+            st.session_state.show_full_history = False
+            st.rerun()
+        
+        if st.button("Clear History", use_container_width=True):
+            if st.session_state.messages:
+                backup_file = f"chat_history_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+                # The append-only file already matches memory, so it becomes the backup as-is
+                close_history_writer()
+                try:
+                    if os.path.exists(HISTORY_FILE):
+                        os.rename(HISTORY_FILE, backup_file)
+                    else:
+                        # Another session cleared the file first, so there is nothing to back up
+                        backup_file = None
+                except OSError as e:
+                    st.error(f"Error backing up chat history: {str(e)}")
+                else:
+                    st.session_state.messages = []
+                    st.session_state.render_window = RENDER_WINDOW_STEP
+                    st.session_state.summary = ""
+                    st.session_state.summary_upto = 0
+                    compact_history([])
+                    if backup_file:
+                        st.info(f"History cleared! Backup saved as {backup_file}")
+                    st.rerun()
+    
+    with col2:
+        if st.button("Logout", use_container_width=True):
+            st.session_state.authenticated = False
+            st.session_state.openai_key = None
+            st.rerun()
+
 def main():
     st.title("🤖 OpenAI Chat Interface")
     
-    # Load history at startup if not already loaded
-    if not st.session_state.history_loaded:
-        st.session_state.messages = load_chat_history()
-        st.session_state.history_loaded = True
+    # Load history at startup, or again only if another session changed the file
+    get_chat_history()
     
     # App Authentication
     if not st.session_state.authenticated:
@@ -244,7 +1002,7 @@ def main():
             if submitted:
                 if authenticate_app(password):
                     st.session_state.authenticated = True
-                    st.experimental_rerun()
+                    st.rerun()
                 else:
                     st.error("Incorrect password!")
         return
@@ -256,74 +1014,7 @@ def main():
 
     # Main Interface with sidebar
     with st.sidebar:
-        st.header("Settings")
-        show_history = st.checkbox("Show Full History", value=st.session_state.show_full_history)
-        st.session_state.show_full_history = show_history
-        
-        st.header("File Upload")
-        uploaded_files = st.file_uploader(
-            "Upload files to discuss",
-            type=ALLOWED_TYPES,
-            accept_multiple_files=True
-        )
-        
-        if uploaded_files:
-            if st.button("Analyze Files", use_container_width=True):
-                for uploaded_file in uploaded_files:
-                    if uploaded_file.type.startswith('image/'):
-                        st.image(uploaded_file, caption=uploaded_file.name)
-                        img_base64 = process_image(uploaded_file)
-                        if img_base64:
-                            response, error = chat_with_openai_vision(
-                                f"Please analyze this image: {uploaded_file.name}",
-                                img_base64,
-                                st.session_state.messages
-                            )
-                            if error:
-                                st.error(error)
-                            else:
-                                new_message = {
-                                    "role": "assistant",
-                                    "content": response,
-                                    "timestamp": datetime.now().isoformat()
-                                }
-                                st.session_state.messages.append(new_message)
-                                save_chat_history(st.session_state.messages)
-                    else:
-                        content, error = process_file(uploaded_file)
-                        if error:
-                            st.error(error)
-                        else:
-                            new_message = {
-                                "role": "user",
-                                "content": f"Analyzing file: {uploaded_file.name}\n\n{content}",
-                                "timestamp": datetime.now().isoformat()
-                            }
-                            st.session_state.messages.append(new_message)
-                            save_chat_history(st.session_state.messages)
-        
-        st.markdown("---")
-        col1, col2 = st.columns(2)
-        with col1:
-            if st.button("Clear Display", use_container_width=True):
-                st.session_state.show_full_history = False
-                st.experimental_rerun()
-            
-            if st.button("Clear History", use_container_width=True):
-                if st.session_state.messages:
-                    backup_file = f"chat_history_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-                    save_chat_history(st.session_state.messages)
-                    os.rename(HISTORY_FILE, backup_file)
-                    st.session_state.messages = []
-                    save_chat_history([])
-                    st.info(f"History cleared! Backup saved as {backup_file}")
-                    st.experimental_rerun()
-        
-        with col2:
-            if st.button("Logout", use_container_width=True):
-                st.session_state.authenticated = False
-                st.session_state.openai_key = None
-                st.experimental_rerun()
+        sidebar_ui()
     
     # Main chat area with input at bottom
     chat_container = st.container()
@@ -335,46 +1026,41 @@ def main():
     
     # Display messages in chat container
     with chat_container:
-        messages_to_show = (
-            st.session_state.messages if st.session_state.show_full_history 
-            else st.session_state.messages[-10:] if st.session_state.messages 
-            else []
-        )
-        
-        for message in messages_to_show:
-            with st.chat_message(message["role"]):
-                st.write(message["content"])
-                if "timestamp" in message:
-                    st.caption(f"Time: {message['timestamp']}")
+        render_chat()
     
-    # Handle new messages
+    # Handle new messages, drawing them below the log instead of rerunning the whole app
     if prompt:
-        # Add user message
-        new_message = {
-            "role": "user",
-            "content": prompt,
-            "timestamp": datetime.now().isoformat()
-        }
-        st.session_state.messages.append(new_message)
-        save_chat_history(st.session_state.messages)
-        
-        # Get assistant response
-        with st.chat_message("assistant"):
-            response, error = chat_with_openai(prompt, st.session_state.messages)
-            if error:
-                st.error(error)
-            else:
-                st.write(response)
-                assistant_message = {
-                    "role": "assistant",
-                    "content": response,
-                    "timestamp": datetime.now().isoformat()
-                }
-                st.session_state.messages.append(assistant_message)
-                save_chat_history(st.session_state.messages)
-        
-        # Rerun to update the chat display
-        st.experimental_rerun()
+        # The user and assistant messages are persisted together
+        with chat_container, history_batch():
+            # Add user message
+            new_message = {
+                "role": "user",
+                "content": prompt,
+                "ts": int(time.time() * 1000)
+            }
+            append_message(new_message)
+            with st.chat_message("user"):
+                st.write(prompt)
+                render_caption(new_message)
+            
+            # Get assistant response
+            with st.chat_message("assistant"):
+                stream, error = chat_with_openai(st.session_state.messages)
+                if stream:
+                    try:
+                        response = st.write_stream(stream)
+                    except Exception as e:
+                        error = str(e)
+                if error:
+                    st.error(error)
+                else:
+                    assistant_message = {
+                        "role": "assistant",
+                        "content": response,
+                        "ts": int(time.time() * 1000)
+                    }
+                    append_message(assistant_message)
+                    render_caption(assistant_message)
 
 if __name__ == "__main__":
     main()